@@ -2,53 +2,394 @@
 
 # standard library
 import argparse
+import array
 import ast
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import importlib
+import importlib.util
 import inspect
+import io
+import itertools
 import json
 import math
 import os
 import re
 import sys
 import time
+import types
 import unittest
 
 
-class CodeTracer(ast.NodeTransformer):
+class CodeTracer:
   """Traces, compiles, and executes an abstract syntax tree."""
 
-  __INJECT_NAME = '__code_tracer__'
+  __COUNTS_NAME = '__code_tracer_counts__'
+  __TIMES_NAME = '__code_tracer_times__'
+  __CLOCK_NAME = '__code_tracer_clock__'
+
+  # statements which are compiled into a separate code object
+  __SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+  # nodes, other than statements, which contain statements (`except` clauses
+  # and, on python 3.10+, `case` clauses)
+  __BLOCKS = tuple(
+    getattr(ast, name)
+    for name in ('excepthandler', 'match_case')
+    if hasattr(ast, name)
+  )
+
+  # the sys.monitoring tool id (python 3.12+), or False if it's unavailable
+  __monitoring_tool = None
+
+  # monitored code objects, mapped to the ids of the statements they contain,
+  # keyed by line number, and to the event handlers of their tracer
+  __monitored_code = {}
 
   @staticmethod
-  def from_source_file(filename):
+  def from_source_file(filename, optimize=0, monitor=False):
     """Create a CodeTracer for the given source file."""
 
-    # read the file, parse the AST, and return a tracer
-    with open(filename) as f:
+    # parse the file, and return a tracer
+    with open(filename, 'rb') as f:
       src = f.read()
-    tree = ast.parse(src)
-    return CodeTracer(tree, filename)
-
-  def __init__(self, tree, filename):
-    # a list of all statements in the injected module
-    self.nodes = []
+    tree = ast.parse(src, filename)
+    tracer = CodeTracer(tree, filename, optimize, monitor)
+    # decode like the import system does, honoring any encoding declaration
+    tracer.source = importlib.util.decode_source(src)
+    return tracer
+
+  def __init__(self, tree, filename, optimize=0, monitor=False):
+    # all statements in the injected module, and their execution counts and
+    # cumulative execution times, stored as parallel arrays
+    self.node_refs = []
+    self.counters = array.array('Q')
+    self.times = array.array('d')
+    # whether each statement is a constant (e.g. a docstring or `...`)
+    self.constant_flags = bytearray()
+    # whether each statement is removed by the compiler at the optimization
+    # level (e.g. an assert), see `__find_removed_statements`
+    self.removed_flags = bytearray()
+    self.__removed_statements = set()
     self.original_tree = tree
     self.filename = filename
+    # the source code of the AST, if known
+    self.source = None
+    # the optimization level passed to `compile`; at level 1 and above asserts
+    # are removed, and at level 2 docstrings are also removed
+    self.optimize = optimize
+    # whether to use sys.monitoring (python 3.12+) instead of injecting tracers
+    # into the AST; it leaves the code untouched, but it's several times slower
+    self.monitor = monitor
+    # statements being timed in each frame, used with sys.monitoring
+    self.__open_statements = {}
+    # first and last lines spanned by each statement, used with sys.monitoring
+    self.__first_lines = array.array('l')
+    self.__last_lines = array.array('l')
+    # parts of tracers shared by all statements, see `__make_templates`
+    self.__templates = None
+    # what was executed while loading, see `reset_counters`
+    self.__initial_counters = array.array('Q')
+    self.__initial_times = array.array('d')
+    # line numbers, ids, and other fixed data of statements, see `get_coverage`
+    self.__sorted_statements = None
 
   def run(self):
     """Trace, compile, and execute the AST, and return global variables."""
 
-    # inject code tracing calls into the AST
-    tree = self.visit(self.original_tree)
-    ast.fix_missing_locations(tree)
+    self.__removed_statements = self.__find_removed_statements()
+    if self.monitor and CodeTracer.__start_monitoring():
+      # the interpreter reports executed lines (python 3.12+)
+      global_vars = self.__run_monitored()
+    else:
+      # inject tracing calls into the AST
+      global_vars = self.__run_injected()
 
-    # execute the new AST, and keep track of global variables it creates
-    global_vars = {CodeTracer.__INJECT_NAME: self}
-    exec(compile(tree, self.filename, 'exec'), global_vars)
+    # remember what was executed while loading, see `reset_counters`
+    self.__initial_counters = self.counters[:]
+    self.__initial_times = self.times[:]
+    # statements were added, so any earlier coverage is out of date
+    self.__sorted_statements = None
 
     # return the global variables
     return global_vars
 
+  def __run_injected(self):
+    """Inject tracing calls into the AST, and execute it."""
+
+    # inject code tracing calls into the AST, sharing the parts of the tracers
+    # which are the same for all statements
+    self.__templates = CodeTracer.__make_templates()
+    tree = self.__instrument(self.original_tree)
+
+    # execution counts and times are updated directly by the injected code
+    self.counters = array.array('Q', [0]) * len(self.node_refs)
+    self.times = array.array('d', [0]) * len(self.node_refs)
+
+    # execute the new AST, and keep track of global variables it creates
+    global_vars = {
+      CodeTracer.__COUNTS_NAME: self.counters,
+      CodeTracer.__TIMES_NAME: self.times,
+      CodeTracer.__CLOCK_NAME: time.perf_counter,
+    }
+    code = compile(tree, self.filename, 'exec', optimize=self.optimize)
+    exec(code, global_vars)
+    return global_vars
+
+  def __run_monitored(self):
+    """Execute the unmodified AST while monitoring executed lines."""
+
+    # statement ids by line number for each scope, keyed like code objects
+    scopes = {}
+    first_lines, last_lines = [], []
+
+    def find_statements(node, line_ids):
+      for child in ast.iter_child_nodes(node):
+        if not isinstance(child, ast.stmt):
+          find_statements(child, line_ids)
+          continue
+
+        # a statement spans its decorators, if any, and its body
+        decorators = getattr(child, 'decorator_list', [])
+        first_line = min([child.lineno] + [d.lineno for d in decorators])
+        node_id = self.__add_statement(child)
+        if not (self.constant_flags[node_id] or self.removed_flags[node_id]):
+          # constants, like docstrings, and removed statements are never
+          # counted
+          line_ids.setdefault(child.lineno, node_id)
+        first_lines.append(first_line)
+        last_lines.append(child.end_lineno)
+
+        # functions and classes are compiled into their own code objects
+        if isinstance(child, CodeTracer.__SCOPES):
+          find_statements(child, scopes.setdefault((child.name, first_line), {}))
+        else:
+          find_statements(child, line_ids)
+
+    module_line_ids = {}
+    find_statements(self.original_tree, module_line_ids)
+    self.__first_lines = array.array('l', first_lines)
+    self.__last_lines = array.array('l', last_lines)
+    self.counters = array.array('Q', [0]) * len(self.node_refs)
+    self.times = array.array('d', [0]) * len(self.node_refs)
+
+    # find the scope of each code object, ignoring lambdas and the like
+    module_code = compile(
+      self.original_tree, self.filename, 'exec', optimize=self.optimize)
+    code_objects = [module_code]
+    for code in code_objects:
+      for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+          code_objects.append(const)
+    monitoring = sys.monitoring
+    events = (
+      monitoring.events.LINE |
+      monitoring.events.PY_RETURN |
+      monitoring.events.PY_YIELD |
+      monitoring.events.PY_RESUME
+    )
+    # event handlers are created once, rather than bound on every event
+    handlers = self.__make_handlers()
+    for code in code_objects:
+      if code is module_code:
+        line_ids = module_line_ids
+      else:
+        line_ids = scopes.get((code.co_name, code.co_firstlineno))
+      if line_ids is not None:
+        CodeTracer.__monitored_code[code] = (line_ids,) + handlers
+        monitoring.set_local_events(CodeTracer.__monitoring_tool, code, events)
+
+    # execute the module, and keep track of global variables it creates
+    global_vars = {}
+    exec(module_code, global_vars)
+    return global_vars
+
+  @staticmethod
+  def __start_monitoring():
+    """
+    Claim a sys.monitoring tool id and register callbacks, if not already
+    done, and return whether sys.monitoring can be used.
+    """
+
+    if CodeTracer.__monitoring_tool is None:
+      CodeTracer.__monitoring_tool = False
+      monitoring = getattr(sys, 'monitoring', None)
+      if monitoring is None:
+        # python 3.11 or older
+        return False
+      tool = monitoring.COVERAGE_ID
+      try:
+        monitoring.use_tool_id(tool, 'py3tester')
+      except ValueError:
+        # already in use, e.g. by coverage.py
+        return False
+      events = monitoring.events
+      monitoring.register_callback(tool, events.LINE, CodeTracer.__on_line)
+      monitoring.register_callback(tool, events.PY_RETURN, CodeTracer.__on_exit)
+      monitoring.register_callback(tool, events.PY_UNWIND, CodeTracer.__on_exit)
+      monitoring.register_callback(tool, events.PY_YIELD, CodeTracer.__on_yield)
+      monitoring.register_callback(tool, events.PY_RESUME, CodeTracer.__on_resume)
+      monitoring.register_callback(tool, events.PY_THROW, CodeTracer.__on_resume)
+      # unwinding and throwing into generators can't be monitored per code
+      # object
+      monitoring.set_events(tool, events.PY_UNWIND | events.PY_THROW)
+      CodeTracer.__monitoring_tool = tool
+
+    return CodeTracer.__monitoring_tool is not False
+
+  @staticmethod
+  def __on_line(code, line):
+    """Handle a sys.monitoring LINE event."""
+    line_ids, trace_line, _, _ = CodeTracer.__monitored_code[code]
+    trace_line(sys._getframe(1), line, line_ids.get(line))
+
+  @staticmethod
+  def __on_exit(code, offset, value):
+    """Handle a sys.monitoring PY_RETURN or PY_UNWIND event."""
+    entry = CodeTracer.__monitored_code.get(code)
+    if entry is not None:
+      entry[2](sys._getframe(1))
+
+  @staticmethod
+  def __on_yield(code, offset, value):
+    """Handle a sys.monitoring PY_YIELD event."""
+    trace_suspend = CodeTracer.__monitored_code[code][3]
+    trace_suspend(sys._getframe(1), time.perf_counter())
+
+  @staticmethod
+  def __on_resume(code, offset, exception=None):
+    """
+    Handle a sys.monitoring PY_RESUME event, or a PY_THROW event (with an
+    exception) when a suspended generator is resumed by `throw`.
+    """
+    entry = CodeTracer.__monitored_code.get(code)
+    if entry is not None:
+      entry[3](sys._getframe(1), -time.perf_counter())
+
+  def __make_handlers(self):
+    """
+    Return functions which count and time statements as lines of a frame are
+    executed, as the frame exits, and as it's suspended or resumed.
+
+    The functions are closures over everything they use, so that their many
+    calls don't look up attributes or globals.
+    """
+
+    perf_counter = time.perf_counter
+    open_statements = self.__open_statements
+    first_lines, last_lines = self.__first_lines, self.__last_lines
+    counters, times = self.counters, self.times
+
+    def trace_line(frame, line, node_id):
+      """
+      Count and time statements as the given line of the given frame is about
+      to be executed.
+
+      A statement is timed from its first line until the frame reaches a line
+      outside of the statement or returns. Reaching the first line of a
+      statement which is still being timed, like the header of a loop, doesn't
+      count as another execution.
+      """
+
+      now = perf_counter()
+      stack = open_statements.get(frame)
+      if stack is None:
+        stack = open_statements[frame] = []
+
+      # stop timing statements which don't contain this line
+      while stack:
+        open_id = stack[-1]
+        if first_lines[open_id] <= line <= last_lines[open_id]:
+          break
+        times[stack.pop()] += now
+
+      # start timing a new statement
+      if node_id is not None and not (stack and stack[-1] == node_id):
+        counters[node_id] += 1
+        times[node_id] -= now
+        stack.append(node_id)
+
+    def trace_exit(frame):
+      """Stop timing all statements of the given frame as it exits."""
+      stack = open_statements.pop(frame, None)
+      if stack:
+        now = perf_counter()
+        for node_id in stack:
+          times[node_id] += now
+
+    def trace_suspend(frame, now):
+      """
+      Pause timing of the statements of the given frame when it yields (`now`
+      is the current time) or resume timing when it continues (`now` is the
+      negative of the current time).
+
+      Time spent suspended isn't attributed to any statement, which also means
+      that generators which are never resumed don't affect timing.
+      """
+      for node_id in open_statements.get(frame, ()):
+        times[node_id] += now
+
+    return trace_line, trace_exit, trace_suspend
+
+  def reset_counters(self):
+    """
+    Reset execution counts and times to what they were just after the module
+    was loaded by `run`.
+
+    This allows the same loaded module to be shared by multiple test runs.
+    """
+    self.counters[:] = self.__initial_counters
+    self.times[:] = self.__initial_times
+    self.__open_statements.clear()
+
+  @property
+  def nodes(self):
+    """
+    Return a list of dicts, each containing a statement (`node`) and its
+    execution count (`counter`) and time (`time`).
+
+    This is a view of `node_refs`, `counters`, and `times`, which should be
+    used instead where possible.
+    """
+    return [
+      {'node': node, 'counter': counter, 'time': elapsed}
+      for node, counter, elapsed in zip(
+        self.node_refs, self.counters, self.times)
+    ]
+
+  def __add_statement(self, node):
+    """Record a statement of the target module and return its identifier."""
+    node_id = len(self.node_refs)
+    self.node_refs.append(node)
+    is_constant = isinstance(node, ast.Expr) and \
+      isinstance(node.value, ast.Constant)
+    self.constant_flags.append(is_constant)
+    self.removed_flags.append(id(node) in self.__removed_statements)
+    return node_id
+
+  def __find_removed_statements(self):
+    """
+    Return the ids (see `id`) of statements which the compiler removes at the
+    optimization level: at level 1 and above, asserts, and `if __debug__:`
+    statements along with their bodies (but not their `else` branches).
+    """
+
+    removed = set()
+    if not self.optimize:
+      return removed
+    for node in ast.walk(self.original_tree):
+      if isinstance(node, ast.Assert):
+        removed.add(id(node))
+      elif isinstance(node, ast.If) and isinstance(node.test, ast.Name) and \
+          node.test.id == '__debug__':
+        removed.add(id(node))
+        for child in node.body:
+          removed.update(
+            id(n) for n in ast.walk(child) if isinstance(n, ast.stmt))
+    return removed
+
   def get_coverage(self):
     """
     Return code coverage as a list of execution counts and other metadata for
@@ -59,91 +400,178 @@ class CodeTracer(ast.NodeTransformer):
       - line: the line number of the statement (1-indexed)
       - column: the column number of the statement (0-indexed)
       - is_constant: a boolean indicating whether the statement was a constant
+      - is_removed: a boolean indicating whether the statement was removed by
+        the compiler at the optimization level
 
     The list is sorted by line number.
     """
 
-    # returns whether the node is a constant (e.g. a docstring or `...`)
-    def is_constant(node):
-      if not isinstance(node, ast.Expr):
-        return False
-      return isinstance(node.value, ast.Constant)
-
-    # iterate over all nodes
-    coverage = []
-    for node_info in self.nodes:
-      node = node_info['node']
-
-      # coverage result for the current node
-      coverage.append({
-        'executions': node_info['counter'],
-        'time': node_info['time'],
-        'line': node.lineno,
-        'column': node.col_offset,
-        'is_constant': is_constant(node),
-      })
+    # statements don't change after the AST is executed, so they are sorted
+    # by line number only once, even if the tracer is reused
+    if self.__sorted_statements is None:
+      self.__sorted_statements = sorted(
+        (
+          node.lineno,
+          i,
+          node.col_offset,
+          bool(self.constant_flags[i]),
+          bool(self.removed_flags[i]),
+        )
+        for i, node in enumerate(self.node_refs)
+      )
 
     # return sorted coverage results
-    return sorted(coverage, key=lambda row: row['line'])
+    counters, times = self.counters, self.times
+    return [
+      {
+        'executions': counters[i],
+        'time': times[i],
+        'line': line,
+        'column': column,
+        'is_constant': is_constant,
+        'is_removed': is_removed,
+      }
+      for line, i, column, is_constant, is_removed in self.__sorted_statements
+    ]
 
-  def execute_node1(self, node_id):
-    """Increment the execution counter, and start timing the given node."""
-    self.nodes[node_id]['counter'] += 1
-    self.nodes[node_id]['time'] -= time.time()
+  @staticmethod
+  @functools.lru_cache(maxsize=None)
+  def __make_templates():
+    """
+    Return AST nodes which are shared by the tracers of all statements.
 
-  def execute_node2(self, node_id):
-    """Stop timing the given node."""
-    self.nodes[node_id]['time'] += time.time()
+    The compiler doesn't modify the AST, so these nodes can be referenced from
+    multiple places in the tree, and by the trees of multiple tracers. Line
+    number 0 indicates that they aren't part of the original source.
+    """
 
-  def generic_visit(self, node):
+    def template(node_type, **kwargs):
+      loc = {'lineno': 0, 'col_offset': 0, 'end_lineno': 0, 'end_col_offset': 0}
+      return node_type(**kwargs, **loc)
+
+    load = ast.Load()
+    clock = template(ast.Name, id=CodeTracer.__CLOCK_NAME, ctx=load)
+    return {
+      'counts': template(ast.Name, id=CodeTracer.__COUNTS_NAME, ctx=load),
+      'times': template(ast.Name, id=CodeTracer.__TIMES_NAME, ctx=load),
+      'now': template(ast.Call, func=clock, args=[], keywords=[]),
+      'one': template(ast.Constant, value=1),
+      'store': ast.Store(),
+      'add': ast.Add(),
+      'sub': ast.Sub(),
+    }
+
+  def __instrument(self, tree):
     """
-    Visit an AST node and add tracing if it's a statement.
+    Add tracing to every statement in the given AST, in place.
 
-    This method shouldn't be called directly. It is called by the super class
-    when the `run` method of this class is called.
+    The tree is walked iteratively, visiting only statements and the blocks
+    which contain them. Expressions and other nodes are skipped since they
+    can't contain statements.
     """
 
-    # let the super class visit this node first
-    super().generic_visit(node)
+    stack = [tree]
+    while stack:
+      node = stack.pop()
+      for field in node._fields:
+        value = getattr(node, field, None)
+        if not isinstance(value, list) or not value:
+          continue
+        if isinstance(value[0], ast.stmt):
+          # statement lists are rebuilt with tracers around each statement,
+          # except that the counters of future imports are deferred until
+          # after the last one, since nothing else may come between them
+          body = []
+          deferred = []
+          for child in value:
+            stack.append(child)
+            traced = self.__instrument_statement(child)
+            if CodeTracer.__is_future_import(child):
+              body.append(child)
+              deferred.extend(traced[1:])
+              continue
+            body.extend(deferred)
+            deferred.clear()
+            body.extend(traced)
+          body.extend(deferred)
+          setattr(node, field, body)
+        elif isinstance(value[0], CodeTracer.__BLOCKS):
+          stack.extend(value)
+    return tree
 
-    # only trace statements
-    if not isinstance(node, ast.stmt):
-      return node
+  @staticmethod
+  def __is_future_import(node):
+    """Return whether the given statement is a `from __future__` import."""
+    return isinstance(node, ast.ImportFrom) and node.module == '__future__'
+
+  def __instrument_statement(self, node):
+    """Return a list of statements which trace and execute the given one."""
 
     # a unique identifier and initial data for this node
-    node_id = len(self.nodes)
-    self.nodes.append({
-      'node': node,
-      'counter': 0,
-      'time': 0,
-    })
+    node_id = self.__add_statement(node)
+
+    # constants, like docstrings, are recorded but not traced, which also keeps
+    # docstrings in place
+    if self.constant_flags[node_id]:
+      return [node]
+
+    # statements which are optimized away are never executed, so they aren't
+    # traced either
+    if self.removed_flags[node_id]:
+      return [node]
+
+    # generated nodes spoof the location of this node, which saves a pass of
+    # `ast.fix_missing_locations` over the whole tree
+    # (end positions were added in python 3.8)
+    loc = {
+      'lineno': node.lineno,
+      'col_offset': node.col_offset,
+      'end_lineno': getattr(node, 'end_lineno', None),
+      'end_col_offset': getattr(node, 'end_col_offset', None),
+    }
+
+    # only the unique node identifier differs between tracers
+    templates = self.__templates
+    node_id_constant = ast.Constant(value=node_id, **loc)
+    if sys.version_info < (3, 9):
+      # python 3.8 still requires subscripts to be wrapped in an index node
+      node_id_constant = ast.Index(value=node_id_constant)
+
+    # each tracer updates one element of an array in place, e.g.
+    # `__code_tracer_counts__[node_id] += 1`, without calling back into python
+    def update(array, op, value):
+      target = ast.Subscript(
+        value=templates[array],
+        slice=node_id_constant,
+        ctx=templates['store'],
+        **loc
+      )
+      return ast.AugAssign(target=target, op=templates[op], value=value, **loc)
 
-    # tracing is done by calling "execute_node" of this class
-    func1 = ast.Attribute(
-      value=ast.Name(id=CodeTracer.__INJECT_NAME, ctx=ast.Load()),
-      attr='execute_node1',
-      ctx=ast.Load()
-    )
-    func2 = ast.Attribute(
-      value=ast.Name(id=CodeTracer.__INJECT_NAME, ctx=ast.Load()),
-      attr='execute_node2',
-      ctx=ast.Load()
-    )
+    # count the statement, and time it by subtracting the clock before and
+    # adding it back after
+    counter = update('counts', 'add', templates['one'])
+    tracer1 = update('times', 'sub', templates['now'])
+    tracer2 = update('times', 'add', templates['now'])
 
-    # the argument to the tracing function is the unique node identifier
-    args = [ast.Num(n=node_id)]
+    # future imports must precede all other code, so they're counted after
+    # they're executed (see `__instrument`), and aren't timed
+    if CodeTracer.__is_future_import(node):
+      return [node, counter]
 
-    # the tracer will be executed whenever the statement is executed
-    tracer1 = ast.Expr(value=ast.Call(func=func1, args=args, keywords=[]))
-    tracer2 = ast.Expr(value=ast.Call(func=func2, args=args, keywords=[]))
+    # inject tracers in a try-finally construct around this node
+    wrapper = ast.Try(
+      body=[node],
+      handlers=[],
+      orelse=[],
+      finalbody=[tracer2],
+      **loc
+    )
+    return [counter, tracer1, wrapper]
 
-    # spoof location information for the generated node
-    ast.copy_location(tracer1, node)
-    ast.copy_location(tracer2, node)
 
-    # inject tracers in a try-finally construct around this node
-    wrapper = ast.Try(body=[node], handlers=[], orelse=[], finalbody=[tracer2])
-    return [tracer1, wrapper]
+# matches descriptions like "setUpClass (package.module.Class)"
+_TEST_NAME_RE = re.compile('^(\\S+)\\s+\\(\\S+?\\.(\\S+)\\)$')
 
 
 class TestResult(unittest.TextTestResult):
@@ -154,69 +582,80 @@ class TestResult(unittest.TextTestResult):
   SKIP = 0
   PASS = 1
 
-  def __init__(self, *args, **kwargs):
+  def __init__(self, *args, quiet=False, **kwargs):
     super().__init__(*args, **kwargs)
     # keep a list of passed tests
     self.successes = []
     # record the result of all tests
     self.results = {}
+    # whether output is discarded, see `_exc_info_to_string`
+    self.__quiet = quiet
+
+  def _exc_info_to_string(self, err, test):
+    # tracebacks are only formatted to be printed, so skip that work when
+    # output is discarded
+    if self.__quiet:
+      return ''
+    return super()._exc_info_to_string(err, test)
 
-  def __set_result(self, test, skip, error, fail, tb):
+  def __set_result(self, test, status):
     """
     Set the result of the test.
 
     The result is one of these integers: PASS, SKIP, FAIL, or ERROR.
     """
 
-    # derive a friendly name
-    match = re.match('^(\\S+)\\s+\\(\\S+?\\.(\\S+)\\)$', str(test))
-    if match is None:
-      raise Exception('unrocognized test name: "%s"' % test)
-    name = '%s.%s' % (match.group(2), match.group(1))
-
-    # set (or update) the result
-    if skip:
-      self.results[name] = TestResult.SKIP
-    elif error:
-      self.results[name] = TestResult.ERROR
-    elif fail:
-      self.results[name] = TestResult.FAIL
+    # derive a friendly name, without the top-level package or module
+    if isinstance(test, unittest.TestCase):
+      name = test.id().split('.', 1)[-1]
     else:
-      # don't overwrite an earlier result (e.g. of a failed subtest)
-      if self.results.get(name, None) is None:
-        self.results[name] = TestResult.PASS
+      # not an actual test, e.g. an error in a class or module fixture, which
+      # only has a description
+      match = _TEST_NAME_RE.match(str(test))
+      if match is None:
+        name = str(test)
+      else:
+        name = '%s.%s' % (match.group(2), match.group(1))
+
+    # set (or update) the result, but don't let a pass overwrite an earlier
+    # result (e.g. of a failed subtest)
+    if status == TestResult.PASS:
+      self.results.setdefault(name, status)
+    else:
+      self.results[name] = status
 
   def addError(self, test, err):
     super().addError(test, err)
-    self.__set_result(test, False, True, False, err[-1])
+    self.__set_result(test, TestResult.ERROR)
 
   def addFailure(self, test, err):
     super().addFailure(test, err)
-    self.__set_result(test, False, False, True, err[-1])
+    self.__set_result(test, TestResult.FAIL)
 
   def addSuccess(self, test):
     super().addSuccess(test)
     self.successes.append(test)
-    self.__set_result(test, False, False, False, None)
+    self.__set_result(test, TestResult.PASS)
 
   def addSkip(self, test, reason):
     super().addSkip(test, reason)
-    self.__set_result(test, True, False, False, None)
+    self.__set_result(test, TestResult.SKIP)
 
   def addExpectedFailure(self, test, err):
     super().addExpectedFailure(test, err)
-    self.__set_result(test, False, False, False, err[-1])
+    self.__set_result(test, TestResult.PASS)
 
   def addUnexpectedSuccess(self, test):
     super().addUnexpectedSuccess(test)
-    self.__set_result(test, False, False, True, None)
+    self.__set_result(test, TestResult.FAIL)
 
   def addSubTest(self, test, subtest, outcome):
     super().addSubTest(test, subtest, outcome)
-    # a failed or errored subtest fails or errors the whole test
-    fail = outcome is not None
-    tb = outcome[-1] if fail else None
-    self.__set_result(test, False, False, fail, tb)
+    # a failed or errored subtest fails the whole test
+    if outcome is None:
+      self.__set_result(test, TestResult.PASS)
+    else:
+      self.__set_result(test, TestResult.FAIL)
 
 
 class Styler:
@@ -224,26 +663,68 @@ class Styler:
 
   green, gray, red = 32, 37, 31
 
+  # terminal escape sequences which start and end text of each color
+  __PREFIXES = {c: '\x1b[0;%d;40m' % c for c in (green, gray, red)}
+  __SUFFIX = '\x1b[0m'
+
   def __init__(self, json_only=False, use_colors=False, show_source=False):
-    self.__json_only = json_only
     self.__use_colors = use_colors
-    self.__show_source = show_source
+    # whether other lines and source lines are shown, decided once here since
+    # `emit` is called for every line
+    self.__show_other = not json_only
+    self.__show_source = show_source and not json_only
+    # emitted lines, written to standard output together by `flush`
+    self.__lines = []
+
+  @property
+  def show_source(self):
+    """Whether source lines passed to `emit` will be shown."""
+    return self.__show_source
 
   def colorize(self, txt, color):
     """Color the given string."""
     if self.__use_colors:
-      return '\x1b[0;%d;40m%s\x1b[0m' % (color, txt)
+      return Styler.__PREFIXES[color] + txt + Styler.__SUFFIX
     else:
       return txt
 
   def emit(self, txt, is_source=False):
-    """Print the given string, conditional on export settings."""
-    if not self.__json_only and (not is_source or self.__show_source):
-      print(txt)
+    """Buffer the given string, conditional on export settings."""
+    if self.__show_source if is_source else self.__show_other:
+      self.__lines.append(txt)
+
+  def flush(self):
+    """Print all buffered strings with a single write."""
+    if self.__lines:
+      self.__lines.append('')
+      sys.stdout.write('\n'.join(self.__lines))
+      self.__lines.clear()
+
+
+# labels and colors of test results
+_RESULT_STYLES = {
+  TestResult.ERROR: ('error', Styler.red),
+  TestResult.FAIL: ('fail', Styler.red),
+  TestResult.SKIP: ('skip', Styler.gray),
+  TestResult.PASS: ('pass', Styler.green),
+}
+
 
+# tracers and globals of target modules which have already been loaded, keyed
+# by filename and tracing options, so that test files sharing a target only
+# load it once; the modification time and size of the file are stored along
+# with them, so that a target which has changed is loaded again
+_target_cache = {}
 
-def run_tests(filename, output=sys.stdout):
-  """Run all tests in the given file and return unit and coverage resuls."""
+
+def run_tests(filename, output=sys.stdout, optimize=0, monitor=False):
+  """
+  Run all tests in the given file and return unit and coverage resuls.
+
+  Test progress is written to `output`, or discarded if it's None. The test
+  target is compiled at the given optimization level, see `compile`, and is
+  traced with sys.monitoring if `monitor` is true, see `CodeTracer`.
+  """
 
   # get the module name from the filename
   path, ext = filename[:-3], filename[-3:]
@@ -251,11 +732,16 @@ def run_tests(filename, output=sys.stdout):
     raise Exception('not a *.py file: ' + str(filename))
   module_name = path.replace(os.path.sep, '.')
 
-  # needed when the file is in a subdirectory
-  sys.path.append(os.getcwd())
+  # needed when the file is in a subdirectory, but only once, since every
+  # import which misses the module cache searches each entry
+  cwd = os.getcwd()
+  if cwd not in sys.path:
+    sys.path.append(cwd)
 
-  # import the module and determine the test target
-  module = importlib.import_module(module_name)
+  # import the module, unless it already is, and determine the test target
+  module = sys.modules.get(module_name)
+  if module is None:
+    module = importlib.import_module(module_name)
   target_module = getattr(module, '__test_target__', None)
   if target_module is None:
     message = (
@@ -263,15 +749,26 @@ def run_tests(filename, output=sys.stdout):
       '%s missing attribute __test_target__. '
       'Coverage will not be tracked.'
     )
-    print(message % module_name, file=output)
+    if output is not None:
+      print(message % module_name, file=output)
     target_file = None
   else:
     target_file = target_module.replace('.', os.path.sep) + '.py'
 
   if target_file:
-    # trace execution while loading the target file
-    tracer = CodeTracer.from_source_file(target_file)
-    global_vars = tracer.run()
+    cache_key = (target_file, optimize, monitor)
+    stat = os.stat(target_file)
+    file_version = (stat.st_mtime_ns, stat.st_size)
+    cached = _target_cache.get(cache_key)
+    if cached is not None and cached[0] == file_version:
+      # reuse the loaded target, but discard coverage from earlier tests
+      _, tracer, global_vars = cached
+      tracer.reset_counters()
+    else:
+      # trace execution while loading the target file
+      tracer = CodeTracer.from_source_file(target_file, optimize, monitor)
+      global_vars = tracer.run()
+      _target_cache[cache_key] = (file_version, tracer, global_vars)
 
     # make the target's globals available to the test module
     for key in global_vars:
@@ -280,17 +777,27 @@ def run_tests(filename, output=sys.stdout):
 
   # load and run unit tests
   tests = unittest.defaultTestLoader.loadTestsFromModule(module)
-  runner = unittest.TextTestRunner(
-    stream=output,
-    verbosity=2,
-    resultclass=TestResult
-  )
-  unit_info = runner.run(tests)
+  with contextlib.ExitStack() as stack:
+    if output is None:
+      # the runner always writes a summary, but don't describe each test
+      stream = stack.enter_context(open(os.devnull, 'w'))
+      verbosity = 0
+    else:
+      stream = output
+      verbosity = 2
+    runner = unittest.TextTestRunner(
+      stream=stream,
+      verbosity=verbosity,
+      resultclass=functools.partial(TestResult, quiet=output is None)
+    )
+    unit_info = runner.run(tests)
 
   if target_file:
     coverage_results = tracer.get_coverage()
+    target_source = tracer.source
   else:
     coverage_results = None
+    target_source = None
 
   # return unit and coverage results
   return {
@@ -298,26 +805,43 @@ def run_tests(filename, output=sys.stdout):
     'coverage': coverage_results,
     'target_module': target_module,
     'target_file': target_file,
+    'target_source': target_source,
   }
 
 
+def _iter_files(location, pattern, recursive):
+  """
+  Yield the paths of files in the given directory, and optionally in its
+  subdirectories, with names matching the given compiled regex.
+
+  Symbolic links to directories aren't followed, and directories which can't
+  be read are skipped.
+  """
+  try:
+    entries = os.scandir(location)
+  except OSError:
+    return
+  subdirs = []
+  with entries:
+    for entry in entries:
+      # the type of an entry is usually known without an extra system call
+      if pattern.match(entry.name) and not entry.is_dir():
+        yield entry.path
+      elif recursive and entry.is_dir(follow_symlinks=False):
+        subdirs.append(entry.path)
+  for subdir in subdirs:
+    yield from _iter_files(subdir, pattern, recursive)
+
+
 def find_tests(location, regex, terminal):
   """Find files containing unit tests."""
   if not os.path.exists(location):
     return []
   elif os.path.isdir(location):
     pattern = re.compile(regex)
-    file_set = set()
-    for dir_, dirs, files in os.walk(location):
-      for f in files:
-        if pattern.match(f):
-          file_set.add(os.path.join(dir_, f))
-      if terminal:
-        break
-    return sorted(file_set)
+    return sorted(_iter_files(location, pattern, not terminal))
   else:
     return [location]
-  return tests_files
 
 
 def analyze_results(results, styler=None):
@@ -351,12 +875,7 @@ def analyze_results(results, styler=None):
   for name in sorted(results['unit'].keys()):
     result = results['unit'][name]
     test_bins[result] += 1
-    txt, color = {
-      -2: ('error', Styler.red),
-      -1: ('fail', Styler.red),
-      0: ('skip', Styler.gray),
-      1: ('pass', Styler.green),
-    }[result]
+    txt, color = _RESULT_STYLES[result]
     export['unit']['tests'][name] = txt
     styler.emit(' %s: %s' % (name, styler.colorize(txt, color)))
 
@@ -384,11 +903,24 @@ def analyze_results(results, styler=None):
 
   if not results['target_file']:
     # coverage was not computed, return test outcomes only
+    styler.flush()
     return export
 
   # coverage results
   styler.emit('Coverage:')
 
+  def format_duration(d):
+    if d < 1e-3:
+      # less than a millisecond, hide to reduce noise
+      return ''
+    elif d < 10:
+      # millisecond precision for times up to 10 seconds
+      return '%.0f ms' % (d * 1e3)
+    else:
+      return '%.0f sec' % d
+
+  show_source = styler.show_source
+
   def print_line(line, txt, hits, time, required):
     export['coverage']['lines'].append({
       'line': line,
@@ -397,15 +929,12 @@ def analyze_results(results, styler=None):
       'required': required,
     })
 
-    def format_duration(d):
-      if d < 1e-3:
-        # less than a millisecond, hide to reduce noise
-        return ''
-      elif d < 10:
-        # millisecond precision for times up to 10 seconds
-        return '%.0f ms' % (d * 1e3)
-      else:
-        return '%.0f sec' % d
+    if required and time < 0:
+      raise Exception('time travel detected')
+
+    # don't format lines which won't be shown
+    if not show_source:
+      return
 
     if required:
       args = (
@@ -427,31 +956,36 @@ def analyze_results(results, styler=None):
 
     styler.emit(' %4d %s %s' % (line, txt, cov), is_source=True)
 
-    if required and time < 0:
-      raise Exception('time travel detected')
+  # use the source that was traced, if available, to avoid reading it again
+  source = results.get('target_source')
+  if source is None:
+    with open(results['target_file']) as f:
+      source = f.read()
+
+  # split on newlines only, like the parser, rather than using `splitlines`
+  src = source.split('\n')
+  if src[-1] == '':
+    src.pop()
 
-  with open(results['target_file']) as f:
-    src = [(i, line) for (i, line) in enumerate(f.readlines())]
+  # the number of lines executed each number of times, always including 0x
+  hit_bins = collections.Counter({0: 0})
 
-  hit_bins = {0: 0}
+  # walk the source lines in step with the coverage results
+  i = 0
   for row in results['coverage']:
-    while len(src) > 0 and src[0][0] < row['line'] - 1:
-      line, hits, time = src[0][0] + 1, 0, 0
-      txt, src = src[0][1][:-1], src[1:]
-      print_line(line, txt, hits, time, False)
-    line, hits, time = row['line'], row['executions'], row['time']
-    txt, src = src[0][1][:-1], src[1:]
-    required = not row['is_constant']
-    print_line(line, txt, hits, time, required)
+    line = row['line']
+    while i < line - 1:
+      print_line(i + 1, src[i], 0, 0, False)
+      i += 1
+    hits, time = row['executions'], row['time']
+    required = not (row['is_constant'] or row['is_removed'])
+    print_line(line, src[i], hits, time, required)
+    i += 1
     if required:
-      if hits not in hit_bins:
-        hit_bins[hits] = 1
-      else:
-        hit_bins[hits] += 1
-  while len(src) > 0:
-    line, hits, time = src[0][0] + 1, 0, 0
-    txt, src = src[0][1][:-1], src[1:]
-    print_line(line, txt, hits, time, False)
+      hit_bins[hits] += 1
+  while i < len(src):
+    print_line(i + 1, src[i], 0, 0, False)
+    i += 1
 
   for hits in sorted(hit_bins.keys()):
     num = hit_bins[hits]
@@ -475,12 +1009,32 @@ def analyze_results(results, styler=None):
     'percent': lines_hit / max(total_lines, 1),
   }
   styler.emit(' overall: %d%%' % math.floor(100 * lines_hit / total_lines))
+  styler.flush()
 
   # return results
   return export
 
 
-def run_test_sets(location, pattern, terminal, show_json, color, full):
+def _analyze_test_file(filename, show_json, styler, optimize, monitor):
+  """
+  Run and analyze the tests in the given file, and return the analysis along
+  with everything that was printed while doing so.
+
+  This is used to run test files in worker processes.
+  """
+
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    # in JSON mode, suppress other output
+    test_outcomes = run_tests(
+      filename, None if show_json else output, optimize, monitor)
+    test_results = analyze_results(test_outcomes, styler)
+  return test_results, output.getvalue()
+
+
+def run_test_sets(
+    location, pattern, terminal, show_json, color, full, jobs=1, optimize=0,
+    monitor=False):
   """
   Run all test sets and print results to standard output.
 
@@ -496,6 +1050,12 @@ def run_test_sets(location, pattern, terminal, show_json, color, full):
     whether human-readable output should be colorized
   full (bool):
     whether human-readable test target source code should be shown
+  jobs (int):
+    the number of test files to run in parallel, or 0 for one per CPU
+  optimize (int):
+    the optimization level at which test targets are compiled, see `compile`
+  monitor (bool):
+    whether test targets are traced with sys.monitoring (python 3.12+)
   """
 
   # run unit and coverage tests
@@ -521,23 +1081,51 @@ def run_test_sets(location, pattern, terminal, show_json, color, full):
     no_error = not tests_by_outcome['error']
     return no_fail and no_error
 
-  if show_json:
-    # suppress other output
-    all_results = []
-    with open(os.devnull, 'w') as output:
+  # in JSON mode, anything else printed by tests or their targets goes to
+  # standard error, so that it can't end up in the middle of the JSON list
+  json_output = sys.stdout
+  other_output = sys.stderr if show_json else sys.stdout
+
+  def analyze_all():
+    """Yield analyzed results for each test file, in order."""
+    if jobs == 1:
       for filename in test_files:
-        test_outcomes = run_tests(filename, output)
-        test_results = analyze_results(test_outcomes, styler)
-        all_results.append(test_results)
-        for test_name, test_outcome in test_results['unit']['tests'].items():
-          tests_by_outcome[test_outcome].append(test_name)
-    print(json.dumps(all_results))
+        with contextlib.redirect_stdout(other_output):
+          # in JSON mode, suppress other output
+          output = None if show_json else sys.stdout
+          test_outcomes = run_tests(filename, output, optimize, monitor)
+          test_results = analyze_results(test_outcomes, styler)
+        yield test_results
+    else:
+      # run each file in a worker process, and print its output in order
+      with concurrent.futures.ProcessPoolExecutor(jobs or None) as executor:
+        args = (
+          test_files,
+          itertools.repeat(show_json),
+          itertools.repeat(styler),
+          itertools.repeat(optimize),
+          itertools.repeat(monitor),
+        )
+        for test_results, txt in executor.map(_analyze_test_file, *args):
+          other_output.write(txt)
+          yield test_results
+
+  if show_json:
+    # write a JSON list one test file at a time, rather than holding the
+    # results of all test files in memory
+    separator = '['
+    for test_results in analyze_all():
+      json_output.write(separator)
+      json.dump(test_results, json_output)
+      separator = ', '
+      for test_name, test_outcome in test_results['unit']['tests'].items():
+        tests_by_outcome[test_outcome].append(test_name)
+    print(']', file=json_output)
   else:
     # use default output
     num_tests = 0
     total_lines = hit_lines = 0
-    for filename in test_files:
-      test_results = analyze_results(run_tests(filename), styler)
+    for test_results in analyze_all():
       if len(test_results['unit']) > 0:
         unit_stats = test_results['unit']['summary']
         coverage_stats = test_results['coverage']['summary']
@@ -591,10 +1179,22 @@ def run_test_sets(location, pattern, terminal, show_json, color, full):
     print_status('broken', 'error')
 
     styler.emit(txt)
+    styler.flush()
 
   return all_pass_or_skip()
 
 
+def _job_count(value):
+  """Parse the number of parallel jobs, which can't be negative."""
+  try:
+    jobs = int(value)
+  except ValueError:
+    jobs = -1
+  if jobs < 0:
+    raise argparse.ArgumentTypeError('must be 0 or more: %r' % value)
+  return jobs
+
+
 def get_cli_argument_parser():
   """Set up command line arguments and usage.
 
@@ -636,6 +1236,27 @@ def get_cli_argument_parser():
       default=False,
       action='store_true',
       help='show coverage for each line')
+  parser.add_argument(
+      '--jobs',
+      default=1,
+      type=_job_count,
+      help='number of test files to run in parallel (0 for one per CPU)')
+  parser.add_argument(
+      '--optimize',
+      '-O',
+      default=0,
+      type=int,
+      choices=[0, 1, 2],
+      help=(
+        'optimization level for compiling test targets; 1 removes asserts, '
+        'and 2 also removes docstrings (e.g. `__doc__` will be None)'))
+  parser.add_argument(
+      '--monitor',
+      default=False,
+      action='store_true',
+      help=(
+        'trace test targets with sys.monitoring (python 3.12+) instead of '
+        'modifying their code, which is slower'))
   parser.add_argument(
       '--use-exit-code',
       default=False,
@@ -677,7 +1298,10 @@ def main_cli():
       args.terminal,
       args.json,
       args.color,
-      args.full)
+      args.full,
+      args.jobs,
+      args.optimize,
+      args.monitor)
 
   if args.use_exit_code and not all_pass:
     sys.exit(1)